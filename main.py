@@ -8,6 +8,7 @@ from pathlib import Path
 
 import numpy as np
 import torch
+from packaging import version
 from torch.utils.data import DataLoader, DistributedSampler
 
 import datasets
@@ -63,6 +64,12 @@ def get_args_parser():
     parser.add_argument('--num_queries', default=100, type=int,
                         help="Number of query slots")
     parser.add_argument('--pre_norm', action='store_true')
+    parser.add_argument('--compile', action='store_true',
+                        help="Compile the prediction heads with torch.compile to fuse their small kernels")
+    parser.add_argument('--bf16', action='store_true',
+                        help="Run the backbone and the transformers under bfloat16 autocast")
+    parser.add_argument('--channels_last', action='store_true',
+                        help="Use the channels_last memory format for the convolutions of the model")
 
     # * Segmentation
     parser.add_argument('--masks', action='store_true',
@@ -167,7 +174,20 @@ def main(args):
 
     model_without_ddp = model
     if args.distributed:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu])
+        # The graph is the same at every step, but some parameters never get a gradient
+        # (e.g. linear_b/conv_b of transformer_BEV): static_graph handles them without the
+        # per-step traversal of find_unused_parameters. The small head gradients are coalesced
+        # into 25MB buckets, whose memory is shared with the .grad tensors.
+        # static_graph needs torch 1.11 and gradient_as_bucket_view torch 1.7, older versions
+        # keep the default DistributedDataParallel behaviour.
+        ddp_kwargs = {}
+        if version.parse(torch.__version__) >= version.parse('1.7'):
+            ddp_kwargs['gradient_as_bucket_view'] = True
+        if version.parse(torch.__version__) >= version.parse('1.11'):
+            ddp_kwargs['static_graph'] = True
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu],
+                                                          find_unused_parameters=False,
+                                                          bucket_cap_mb=25, **ddp_kwargs)
         model_without_ddp = model.module
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print('number of params:', n_parameters)
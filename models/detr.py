@@ -4,7 +4,7 @@ DETR model and criterion classes.
 """
 import torch
 import torch.nn.functional as F
-from torch import nn
+from torch import nn, Tensor
 
 from util import box_ops
 from util.misc import (NestedTensor, nested_tensor_from_tensor_list,
@@ -18,10 +18,19 @@ from .segmentation import (DETRsegm, PostProcessPanoptic, PostProcessSegm,
 from .transformer import build_transformer
 from .transformer_BEV import build_transformer_BEV
 
+# keys of the per-layer outputs of DETR, in the order returned by DETR._compute_heads
+_OUTPUT_KEYS = ('pred_logits', 'pred_boxes', 'pred_bev', 'pred_dim', 'pred_angle')
+
 
 class DETR(nn.Module):
     """ This is the DETR module that performs object detection """
-    def __init__(self, backbone, transformer, transformer_BEV, num_classes, num_queries, aux_loss=False):
+    # bf16 is a constant so that TorchScript does not compile the autocast branch of models built without it,
+    # see __prepare_scriptable__ for the models built with it
+    __constants__ = ['bf16', 'output_keys']
+    # TorchScript can only iterate over the output keys as a module constant
+    output_keys = _OUTPUT_KEYS
+
+    def __init__(self, backbone, transformer, transformer_BEV, num_classes, num_queries, aux_loss=False, bf16=False):
         """ Initializes the model.
         Parameters:
             backbone: torch module of the backbone to be used. See backbone.py
@@ -30,6 +39,10 @@ class DETR(nn.Module):
             num_queries: number of object queries, ie detection slot. This is the maximal number of objects
                          DETR can detect in a single image. For COCO, we recommend 100 queries.
             aux_loss: True if auxiliary decoding losses (loss at each decoder layer) are to be used.
+            bf16: True to run the backbone and the transformers under bfloat16 autocast. The prediction
+                  heads, and thus the outputs fed to the losses, run in the dtype of the model weights.
+                  Such a model can't be used through TorchScript, set `bf16` to False before scripting it:
+                  the weights are the same and it then runs in their dtype.
         """
         super().__init__()
         self.num_queries = num_queries
@@ -45,6 +58,14 @@ class DETR(nn.Module):
         self.bev_embed = MLP(hidden_dim, hidden_dim, 2, 2)
         self.angle_embed = MLP(hidden_dim, hidden_dim, 24, 2)
         self.dim_embed = MLP(hidden_dim, hidden_dim, 2, 2)
+        self.bf16 = bf16
+
+    def __prepare_scriptable__(self):
+        # called by torch.jit.script. Autocast in TorchScript needs a constant device_type and does not cast
+        # all the operations like eager autocast does (e.g. not the bias of the convolutions), so fail early
+        if self.bf16:
+            raise RuntimeError("DETR models with bf16=True can't be scripted, set bf16 to False before scripting")
+        return self
 
     def forward(self, samples: NestedTensor):
         """ The forward expects a NestedTensor, which consists of:
@@ -63,31 +84,63 @@ class DETR(nn.Module):
         """
         if isinstance(samples, (list, torch.Tensor)):
             samples = nested_tensor_from_tensor_list(samples)
+        layer_outputs = self._forward_layers(samples)
+        out = {k: t[-1] for k, t in zip(self.output_keys, layer_outputs)}
+        if self.aux_loss:
+            out['aux_outputs'] = self._set_aux_loss(*layer_outputs)
+        return out
+
+    @torch.jit.export
+    def inference_forward(self, tensors: Tensor, mask: Tensor):
+        """ Inference-only forward on an already batched input, meant for deployment:
+               - tensors: batched images, of shape [batch_size x 3 x H x W]
+               - mask: a binary mask of shape [batch_size x H x W], containing 1 on padded pixels
+
+            It returns the same dict as forward, without "aux_outputs". It is exported when scripting the
+            model, and is kept by torch.jit.optimize_for_inference(scripted, other_methods=['inference_forward'])
+        """
+        layer_outputs = self._forward_layers(NestedTensor(tensors, mask))
+        return {k: t[-1] for k, t in zip(self.output_keys, layer_outputs)}
+
+    def _forward_layers(self, samples: NestedTensor):
+        # runs the model and returns the outputs of the prediction heads for every decoder layer
+        if self.bf16:
+            with torch.autocast(device_type=samples.tensors.device.type, dtype=torch.bfloat16):
+                hs = self._forward_transformers(samples)
+            # the heads (and thus the losses) run in the dtype of the weights, not in bfloat16
+            hs = hs.to(self.class_embed.weight.dtype)
+        else:
+            hs = self._forward_transformers(samples)
+        return self._compute_heads(hs)
+
+    def _forward_transformers(self, samples: NestedTensor):
         features, pos = self.backbone(samples)
 
         src, mask = features[-1].decompose()
         assert mask is not None
-        query_B = self.transformer(self.input_proj(src), mask, self.query_embed.weight, pos[-1])[0]
-        print(query_B.size())
-        hs = self.transformer_BEV(self.input_proj(src), mask, self.query_embed.weight, pos[-1], query_B)[0]
-
+        # both transformers attend to the same projected features, only project them once
+        proj = self.input_proj(src)
+        query_B = self.transformer(proj, mask, self.query_embed.weight, pos[-1])[0]
+        return self.transformer_BEV(proj, mask, self.query_embed.weight, pos[-1], query_B)[0]
+
+    def _compute_heads(self, hs):
+        # all the prediction heads run on the decoder output of every layer, shape [L, B, Q, D].
+        # They are kept together so that `torch.compile` can fuse this chain of small kernels.
         outputs_class = self.class_embed(hs)
         outputs_coord = self.bbox_embed(hs).sigmoid()
         outputs_bev = self.bev_embed(hs)
         outputs_dim = self.dim_embed(hs)
         outputs_angle = self.angle_embed(hs)
-        out = {'pred_logits': outputs_class[-1], 'pred_boxes': outputs_coord[-1], 'pred_bev': outputs_bev[-1], 'pred_dim': outputs_dim[-1], 'pred_angle': outputs_angle[-1]}
-        if self.aux_loss:
-            out['aux_outputs'] = self._set_aux_loss(outputs_class, outputs_coord, outputs_bev, outputs_dim, outputs_angle)
-        return out
+        return outputs_class, outputs_coord, outputs_bev, outputs_dim, outputs_angle
 
     @torch.jit.unused
     def _set_aux_loss(self, outputs_class, outputs_coord, outputs_bev, outputs_dim, outputs_angle):
         # this is a workaround to make torchscript happy, as torchscript
         # doesn't support dictionary with non-homogeneous values, such
         # as a dict having both a Tensor and a list.
-        return [{'pred_logits': a, 'pred_boxes': b, 'pred_bev': c, 'pred_dim': d, 'pred_angle': e}
-                for a, b, c, d, e in zip(outputs_class[:-1], outputs_coord[:-1], outputs_bev[:-1], outputs_dim[:-1], outputs_angle[:-1])]
+        outputs = (outputs_class, outputs_coord, outputs_bev, outputs_dim, outputs_angle)
+        layers = zip(*(t[:-1].unbind(0) for t in outputs))
+        return [dict(zip(_OUTPUT_KEYS, layer_outputs)) for layer_outputs in layers]
 
 
 class SetCriterion(nn.Module):
@@ -115,14 +168,15 @@ class SetCriterion(nn.Module):
         empty_weight[-1] = self.eos_coef
         self.register_buffer('empty_weight', empty_weight)
 
-    def loss_labels(self, outputs, targets, indices, num_boxes, log=True):
+    def loss_labels(self, outputs, targets, indices, num_boxes, log=True, idx=None):
         """Classification loss (NLL)
         targets dicts must contain the key "labels" containing a tensor of dim [nb_target_boxes]
         """
         assert 'pred_logits' in outputs
         src_logits = outputs['pred_logits']
 
-        idx = self._get_src_permutation_idx(indices)
+        if idx is None:
+            idx = self._get_src_permutation_idx(indices)
         target_classes_o = torch.cat([t["labels"][J] for t, (_, J) in zip(targets, indices)])
         target_classes = torch.full(src_logits.shape[:2], self.num_classes,
                                     dtype=torch.int64, device=src_logits.device)
@@ -137,7 +191,7 @@ class SetCriterion(nn.Module):
         return losses
 
     @torch.no_grad()
-    def loss_cardinality(self, outputs, targets, indices, num_boxes):
+    def loss_cardinality(self, outputs, targets, indices, num_boxes, idx=None):
         """ Compute the cardinality error, ie the absolute error in the number of predicted non-empty boxes
         This is not really a loss, it is intended for logging purposes only. It doesn't propagate gradients
         """
@@ -150,34 +204,40 @@ class SetCriterion(nn.Module):
         losses = {'cardinality_error': card_err}
         return losses
 
-    def loss_boxes(self, outputs, targets, indices, num_boxes):
+    def loss_boxes(self, outputs, targets, indices, num_boxes, idx=None):
         """Compute the losses related to the bounding boxes, the L1 regression loss and the GIoU loss
            targets dicts must contain the key "boxes" containing a tensor of dim [nb_target_boxes, 4]
            The target boxes are expected in format (center_x, center_y, w, h), normalized by the image size.
+           forward also adds them in (x0, y0, x1, y1) format under "boxes_xyxy", as they are shared by all layers,
+           they are converted here when this key is missing.
         """
         assert 'pred_boxes' in outputs
-        idx = self._get_src_permutation_idx(indices)
+        if idx is None:
+            idx = self._get_src_permutation_idx(indices)
         src_boxes = outputs['pred_boxes'][idx]
         target_boxes = torch.cat([t['boxes'][i] for t, (_, i) in zip(targets, indices)], dim=0)
+        if all('boxes_xyxy' in t for t in targets):
+            target_boxes_xyxy = torch.cat([t['boxes_xyxy'][i] for t, (_, i) in zip(targets, indices)], dim=0)
+        else:
+            target_boxes_xyxy = box_ops.box_cxcywh_to_xyxy(target_boxes)
 
         loss_bbox = F.l1_loss(src_boxes, target_boxes, reduction='none')
 
         losses = {}
         losses['loss_bbox'] = loss_bbox.sum() / num_boxes
 
-        loss_giou = 1 - torch.diag(box_ops.generalized_box_iou(
-            box_ops.box_cxcywh_to_xyxy(src_boxes),
-            box_ops.box_cxcywh_to_xyxy(target_boxes)))
+        loss_giou = 1 - box_ops.paired_generalized_box_iou(
+            box_ops.box_cxcywh_to_xyxy(src_boxes), target_boxes_xyxy)
         losses['loss_giou'] = loss_giou.sum() / num_boxes
         return losses
 
-    def loss_masks(self, outputs, targets, indices, num_boxes):
+    def loss_masks(self, outputs, targets, indices, num_boxes, idx=None):
         """Compute the losses related to the masks: the focal loss and the dice loss.
            targets dicts must contain the key "masks" containing a tensor of dim [nb_target_boxes, h, w]
         """
         assert "pred_masks" in outputs
 
-        src_idx = self._get_src_permutation_idx(indices)
+        src_idx = self._get_src_permutation_idx(indices) if idx is None else idx
         tgt_idx = self._get_tgt_permutation_idx(indices)
         src_masks = outputs["pred_masks"]
         src_masks = src_masks[src_idx]
@@ -200,17 +260,18 @@ class SetCriterion(nn.Module):
         }
         return losses
 
-    def loss_bev(self, outputs, targets, indices, num_boxes):
+    def loss_bev(self, outputs, targets, indices, num_boxes, idx=None):
         assert 'pred_bev' in outputs
-        idx = self._get_src_permutation_idx(indices)
-        src_bev = outputs['pred_bev'][idx].squeeze()
+        if idx is None:
+            idx = self._get_src_permutation_idx(indices)
+        src_bev = outputs['pred_bev'][idx]
         target_bev = torch.cat([t['bev'][i] for t, (_, i) in zip(targets, indices)])
         loss = F.l1_loss(src_bev, target_bev, reduction='none')
         losses = {}
         losses['loss_bev'] = loss.sum() / num_boxes
         return losses
 
-    def loss_dims(self, outputs, targets, indices, num_boxes):
+    def loss_dims(self, outputs, targets, indices, num_boxes, idx=None):
         assert 'pred_dim' in outputs
         # idx = self._get_src_permutation_idx(indices)
         # src_dim = outputs['pred_dim'][idx].squeeze()
@@ -218,24 +279,25 @@ class SetCriterion(nn.Module):
         # loss = F.mse_loss(src_dim, target_dim)
         # losses = {'loss_bev' : loss}
 
-        idx = self._get_src_permutation_idx(indices)
+        if idx is None:
+            idx = self._get_src_permutation_idx(indices)
         src_dims = outputs['pred_dim'][idx]
         target_dims = torch.cat([t['dim'][i] for t, (_, i) in zip(targets, indices)], dim=0)
 
-        dimension = target_dims.clone().detach()
-        dim_loss = torch.abs(src_dims - target_dims)
-        dim_loss /= dimension
+        # the targets carry no gradient, so they can directly be used as the relative scale
+        abs_diff = torch.abs(src_dims - target_dims)
+        dim_loss = abs_diff / target_dims
         with torch.no_grad():
-            compensation_weight = F.l1_loss(src_dims, target_dims) / dim_loss.mean()
-        dim_loss *= compensation_weight
+            compensation_weight = abs_diff.mean() / dim_loss.mean()
         losses = {}
-        losses['loss_dim'] = dim_loss.sum() / num_boxes
+        losses['loss_dim'] = (dim_loss * compensation_weight).sum() / num_boxes
 
         return losses
     
-    def loss_angles(self, outputs, targets, indices, num_boxes):  
+    def loss_angles(self, outputs, targets, indices, num_boxes, idx=None):  
 
-        idx = self._get_src_permutation_idx(indices)
+        if idx is None:
+            idx = self._get_src_permutation_idx(indices)
         heading_input = outputs['pred_angle'][idx]
         target_heading_cls = torch.cat([t['heading_bin'][i] for t, (_, i) in zip(targets, indices)], dim=0)
         target_heading_res = torch.cat([t['heading_res'][i] for t, (_, i) in zip(targets, indices)], dim=0)
@@ -250,8 +312,7 @@ class SetCriterion(nn.Module):
 
         # regression loss
         heading_input_res = heading_input[:, 12:24]
-        cls_onehot = torch.zeros(heading_target_cls.shape[0], 12).cuda().scatter_(dim=1, index=heading_target_cls.view(-1, 1), value=1)
-        heading_input_res = torch.sum(heading_input_res * cls_onehot, 1)
+        heading_input_res = heading_input_res.gather(1, heading_target_cls.view(-1, 1)).squeeze(1)
         reg_loss = F.l1_loss(heading_input_res, heading_target_res, reduction='none')
         
         angle_loss = cls_loss + reg_loss
@@ -300,34 +361,42 @@ class SetCriterion(nn.Module):
                       The expected keys in each dict depends on the losses applied, see each loss' doc
         """
         outputs_without_aux = {k: v for k, v in outputs.items() if k != 'aux_outputs'}
+        # the matcher and the box losses of every decoder layer use the target boxes in xyxy format,
+        # convert them only once
+        targets = [dict(t, boxes_xyxy=box_ops.box_cxcywh_to_xyxy(t['boxes'])) for t in targets]
 
-        # Retrieve the matching between the outputs of the last layer and the targets
-        indices = self.matcher(outputs_without_aux, targets)
+        # Retrieve the matching between the outputs of the last layer and the targets,
+        # together with the matching of the intermediate layers when auxiliary losses are used
+        layers_outputs = [outputs_without_aux] + outputs.get('aux_outputs', [])
+        indices, *aux_indices = self.matcher.match_layers(layers_outputs, targets)
 
         # Compute the average number of target boxes accross all nodes, for normalization purposes
+        # It is kept as a 0-d tensor on the device rather than converted with .item(), which would force a sync
         num_boxes = sum(len(t["labels"]) for t in targets)
-        num_boxes = torch.as_tensor([num_boxes], dtype=torch.float, device=next(iter(outputs.values())).device)
+        num_boxes = torch.as_tensor(num_boxes, dtype=torch.float, device=self.empty_weight.device)
         if is_dist_avail_and_initialized():
             torch.distributed.all_reduce(num_boxes)
-        num_boxes = torch.clamp(num_boxes / get_world_size(), min=1).item()
+        num_boxes = torch.clamp(num_boxes / get_world_size(), min=1)
 
-        # Compute all the requested losses
+        # Compute all the requested losses. The permutation of the matched predictions is the same for
+        # all the losses of a layer, so it is built once per layer rather than in every loss
         losses = {}
+        idx = self._get_src_permutation_idx(indices)
         for loss in self.losses:
-            losses.update(self.get_loss(loss, outputs, targets, indices, num_boxes))
+            losses.update(self.get_loss(loss, outputs, targets, indices, num_boxes, idx=idx))
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if 'aux_outputs' in outputs:
-            for i, aux_outputs in enumerate(outputs['aux_outputs']):
-                indices = self.matcher(aux_outputs, targets)
+            for i, (aux_outputs, indices) in enumerate(zip(outputs['aux_outputs'], aux_indices)):
+                idx = self._get_src_permutation_idx(indices)
                 for loss in self.losses:
                     if loss == 'masks':
                         # Intermediate masks losses are too costly to compute, we ignore them.
                         continue
-                    kwargs = {}
+                    kwargs = {'idx': idx}
                     if loss == 'labels':
                         # Logging is enabled only for the last layer
-                        kwargs = {'log': False}
+                        kwargs['log'] = False
                     l_dict = self.get_loss(loss, aux_outputs, targets, indices, num_boxes, **kwargs)
                     l_dict = {k + f'_{i}': v for k, v in l_dict.items()}
                     losses.update(l_dict)
@@ -354,12 +423,12 @@ class PostProcess(nn.Module):
         prob = F.softmax(out_logits, -1)
         scores, labels = prob[..., :-1].max(-1)
 
-        # convert to [x0, y0, x1, y1] format
-        boxes = box_ops.box_cxcywh_to_xyxy(out_bbox)
-        # and from relative [0, 1] to absolute [0, height] coordinates
-        img_h, img_w = target_sizes.unbind(1)
-        scale_fct = torch.stack([img_w, img_h, img_w, img_h], dim=1)
-        boxes = boxes * scale_fct[:, None, :]
+        # convert to [x0, y0, x1, y1] format and from relative [0, 1] to absolute [0, height]
+        # coordinates in a single pass, instead of building a separate scale tensor
+        img_h, img_w = target_sizes[:, 0, None], target_sizes[:, 1, None]
+        x_c, y_c, w, h = out_bbox.unbind(-1)
+        boxes = torch.stack([(x_c - 0.5 * w) * img_w, (y_c - 0.5 * h) * img_h,
+                             (x_c + 0.5 * w) * img_w, (y_c + 0.5 * h) * img_h], dim=-1)
 
         results = [{'scores': s, 'labels': l, 'boxes': b} for s, l, b in zip(scores, labels, boxes)]
 
@@ -373,12 +442,25 @@ class MLP(nn.Module):
         super().__init__()
         self.num_layers = num_layers
         h = [hidden_dim] * (num_layers - 1)
-        self.layers = nn.ModuleList(nn.Linear(n, k) for n, k in zip([input_dim] + h, h + [output_dim]))
+        linears = [nn.Linear(n, k) for n, k in zip([input_dim] + h, h + [output_dim])]
+        # Linear, ReLU, ..., ReLU, Linear, so that forward is a single static sequence of modules
+        self.layers = nn.Sequential(*[m for linear in linears[:-1] for m in (linear, nn.ReLU())], linears[-1])
 
     def forward(self, x):
-        for i, layer in enumerate(self.layers):
-            x = F.relu(layer(x)) if i < self.num_layers - 1 else layer(x)
-        return x
+        return self.layers(x)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        # `layers` used to only hold the Linear layers, the i-th of which is now at index 2 * i.
+        # The ReLUs have no parameters, so a key at index 1 can only come from the old layout.
+        if f'{prefix}layers.1.weight' in state_dict:
+            for i in reversed(range(self.num_layers)):
+                for name in ('weight', 'bias'):
+                    old_key = f'{prefix}layers.{i}.{name}'
+                    if old_key in state_dict:
+                        state_dict[f'{prefix}layers.{2 * i}.{name}'] = state_dict.pop(old_key)
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
 
 
 def build(args):
@@ -410,7 +492,19 @@ def build(args):
         num_classes=num_classes,
         num_queries=args.num_queries,
         aux_loss=args.aux_loss,
+        bf16=args.bf16,
     )
+    if args.bf16:
+        # let the matmuls left in float32 use TF32 tensor cores
+        torch.set_float32_matmul_precision('high')
+    if args.channels_last:
+        # NHWC convolutions in the backbone and input_proj map better onto tensor cores;
+        # their outputs stay channels_last, so no conversion is needed in forward
+        model = model.to(memory_format=torch.channels_last)
+    if args.compile:
+        # only the heads are compiled: their input is always [L, B, Q, D], while the backbone and the
+        # transformers see a new image size with every training scale, which would trigger recompilations
+        model._compute_heads = torch.compile(model._compute_heads, mode='reduce-overhead')
     if args.masks:
         model = DETRsegm(model, freeze_detr=(args.frozen_weights is not None))
     matcher = build_matcher(args)
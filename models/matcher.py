@@ -44,6 +44,7 @@ class HungarianMatcher(nn.Module):
                  "labels": Tensor of dim [num_target_boxes] (where num_target_boxes is the number of ground-truth
                            objects in the target) containing the class labels
                  "boxes": Tensor of dim [num_target_boxes, 4] containing the target box coordinates
+                 "boxes_xyxy": Optional, the same boxes in (x0, y0, x1, y1) format, as added by SetCriterion
 
         Returns:
             A list of size batch_size, containing tuples of (index_i, index_j) where:
@@ -52,15 +53,38 @@ class HungarianMatcher(nn.Module):
             For each batch element, it holds:
                 len(index_i) = len(index_j) = min(num_queries, num_target_boxes)
         """
-        bs, num_queries = outputs["pred_logits"].shape[:2]
+        return self.match_layers([outputs], targets)[0]
+
+    @torch.no_grad()
+    def match_layers(self, outputs_list, targets):
+        """ Performs the matching for the outputs of several decoder layers at once
+
+        The cost matrices of all the layers are computed in a single batch and copied to the CPU together,
+        instead of one computation and one device synchronization per layer.
+
+        Params:
+            outputs_list: list of outputs dicts (one per decoder layer), in the format expected by forward
+            targets: list of targets, in the format expected by forward
+
+        Returns:
+            A list of size len(outputs_list), containing for each layer the matching as returned by forward
+        """
+        num_layers = len(outputs_list)
+        bs, num_queries = outputs_list[0]["pred_logits"].shape[:2]
 
         # We flatten to compute the cost matrices in a batch
-        out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)  # [batch_size * num_queries, num_classes]
-        out_bbox = outputs["pred_boxes"].flatten(0, 1)  # [batch_size * num_queries, 4]
+        # [num_layers * batch_size * num_queries, num_classes]
+        out_prob = torch.stack([o["pred_logits"] for o in outputs_list]).flatten(0, 2).softmax(-1)
+        # [num_layers * batch_size * num_queries, 4]
+        out_bbox = torch.stack([o["pred_boxes"] for o in outputs_list]).flatten(0, 2)
 
         # Also concat the target labels and boxes
         tgt_ids = torch.cat([v["labels"] for v in targets])
         tgt_bbox = torch.cat([v["boxes"] for v in targets])
+        if all("boxes_xyxy" in v for v in targets):
+            tgt_bbox_xyxy = torch.cat([v["boxes_xyxy"] for v in targets])
+        else:
+            tgt_bbox_xyxy = box_cxcywh_to_xyxy(tgt_bbox)
 
         # Compute the classification cost. Contrary to the loss, we don't use the NLL,
         # but approximate it in 1 - proba[target class].
@@ -71,15 +95,16 @@ class HungarianMatcher(nn.Module):
         cost_bbox = torch.cdist(out_bbox, tgt_bbox, p=1)
 
         # Compute the giou cost betwen boxes
-        cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), box_cxcywh_to_xyxy(tgt_bbox))
+        cost_giou = -generalized_box_iou(box_cxcywh_to_xyxy(out_bbox), tgt_bbox_xyxy)
 
         # Final cost matrix
         C = self.cost_bbox * cost_bbox + self.cost_class * cost_class + self.cost_giou * cost_giou
-        C = C.view(bs, num_queries, -1).cpu()
+        C = C.view(num_layers, bs, num_queries, -1).cpu()
 
         sizes = [len(v["boxes"]) for v in targets]
-        indices = [linear_sum_assignment(c[i]) for i, c in enumerate(C.split(sizes, -1))]
-        return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+        indices = [linear_sum_assignment(c[i]) for C_layer in C for i, c in enumerate(C_layer.split(sizes, -1))]
+        indices = [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
+        return [indices[layer * bs:(layer + 1) * bs] for layer in range(num_layers)]
 
 
 def build_matcher(args):
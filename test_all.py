@@ -3,14 +3,18 @@ import io
 import unittest
 
 import torch
+import torch.nn.functional as F
 from torch import nn, Tensor
 from typing import List
 
+from models.detr import DETR, MLP, PostProcess, SetCriterion
 from models.matcher import HungarianMatcher
 from models.position_encoding import PositionEmbeddingSine, PositionEmbeddingLearned
 from models.backbone import Backbone, Joiner, BackboneBase
+from models.transformer import Transformer
 from util import box_ops
 from util.misc import nested_tensor_from_tensor_list
+from torchvision.models import resnet18
 from hubconf import detr_resnet50, detr_resnet50_panoptic
 
 # onnxruntime requires python 3.5 or above
@@ -20,6 +24,29 @@ except ImportError:
     onnxruntime = None
 
 
+class BEVTransformer(nn.Module):
+    """Stand-in for the BEV transformer with the same signature, as its query_B projection is not defined yet"""
+    def __init__(self, transformer):
+        super().__init__()
+        self.transformer = transformer
+
+    def forward(self, src, mask, query_embed, pos_embed, query_B):
+        return self.transformer(src, mask, query_embed, pos_embed)
+
+
+def make_small_detr(**kwargs):
+    hidden_dim = 32
+    backbone = Joiner(BackboneBase(resnet18(), False, 512, False),
+                      PositionEmbeddingSine(hidden_dim // 2, normalize=True))
+    backbone.num_channels = 512
+
+    def make_transformer():
+        return Transformer(d_model=hidden_dim, nhead=4, num_encoder_layers=1, num_decoder_layers=2,
+                           dim_feedforward=64, return_intermediate_dec=True)
+    return DETR(backbone, make_transformer(), BEVTransformer(make_transformer()), num_classes=3, num_queries=10,
+                **kwargs)
+
+
 class Tester(unittest.TestCase):
 
     def test_box_cxcywh_to_xyxy(self):
@@ -27,6 +54,12 @@ class Tester(unittest.TestCase):
         r = box_ops.box_xyxy_to_cxcywh(box_ops.box_cxcywh_to_xyxy(t))
         self.assertLess((t - r).abs().max(), 1e-5)
 
+    def test_paired_generalized_box_iou(self):
+        boxes1 = box_ops.box_cxcywh_to_xyxy(torch.rand(10, 4))
+        boxes2 = box_ops.box_cxcywh_to_xyxy(torch.rand(10, 4))
+        giou = box_ops.paired_generalized_box_iou(boxes1, boxes2)
+        self.assertLess((giou - torch.diag(box_ops.generalized_box_iou(boxes1, boxes2))).abs().max(), 1e-6)
+
     @staticmethod
     def indices_torch2python(indices):
         return [(i.tolist(), j.tolist()) for i, j in indices]
@@ -60,6 +93,163 @@ class Tester(unittest.TestCase):
                            'pred_boxes': boxes.repeat(2, 1, 1)}, targets_empty * 2)
         self.assertEqual(len(indices[0][0]), 0)
 
+    def test_hungarian_layers(self):
+        n_layers, n_queries, n_targets, n_classes = 3, 100, 15, 91
+        logits = torch.rand(n_layers, 2, n_queries, n_classes + 1)
+        boxes = torch.rand(n_layers, 2, n_queries, 4)
+        tgt_labels = torch.randint(high=n_classes, size=(n_targets,))
+        tgt_boxes = torch.rand(n_targets, 4)
+        matcher = HungarianMatcher()
+        targets = [{'labels': tgt_labels, 'boxes': tgt_boxes}, {'labels': tgt_labels[:0], 'boxes': tgt_boxes[:0]}]
+        outputs = [{'pred_logits': lg, 'pred_boxes': bx} for lg, bx in zip(logits, boxes)]
+        indices_layers = matcher.match_layers(outputs, targets)
+        self.assertEqual(len(indices_layers), n_layers)
+        for out, indices in zip(outputs, indices_layers):
+            self.assertEqual(self.indices_torch2python(matcher(out, targets)),
+                             self.indices_torch2python(indices))
+
+    def test_hungarian_boxes_xyxy(self):
+        logits, boxes = torch.rand(2, 100, 92), torch.rand(2, 100, 4)
+        targets = [{'labels': torch.randint(high=91, size=(15,)), 'boxes': torch.rand(15, 4)} for _ in range(2)]
+        targets_xyxy = [dict(t, boxes_xyxy=box_ops.box_cxcywh_to_xyxy(t['boxes'])) for t in targets]
+        matcher = HungarianMatcher()
+        outputs = {'pred_logits': logits, 'pred_boxes': boxes}
+        self.assertEqual(self.indices_torch2python(matcher(outputs, targets)),
+                         self.indices_torch2python(matcher(outputs, targets_xyxy)))
+
+    @staticmethod
+    def reference_losses(outputs, targets, indices, num_boxes, eos_coef):
+        # the losses of a single layer, computed with the formulas of SetCriterion one image at a time
+        src_logits = outputs['pred_logits']
+        num_classes = src_logits.shape[-1] - 1
+        target_classes = torch.full(src_logits.shape[:2], num_classes, dtype=torch.int64)
+        empty_weight = torch.ones(num_classes + 1)
+        empty_weight[-1] = eos_coef
+        pred, tgt = {k: [] for k in outputs}, {k: [] for k in targets[0]}
+        for b, (t, (i, j)) in enumerate(zip(targets, indices)):
+            target_classes[b, i] = t['labels'][j]
+            for k in pred:
+                pred[k].append(outputs[k][b, i])
+            for k in tgt:
+                tgt[k].append(t[k][j])
+        pred, tgt = {k: torch.cat(v) for k, v in pred.items()}, {k: torch.cat(v) for k, v in tgt.items()}
+
+        card_pred = (src_logits.argmax(-1) != num_classes).sum(1).float()
+        giou = torch.diag(box_ops.generalized_box_iou(box_ops.box_cxcywh_to_xyxy(pred['pred_boxes']),
+                                                      box_ops.box_cxcywh_to_xyxy(tgt['boxes'])))
+        dim_loss = (pred['pred_dim'] - tgt['dim']).abs() / tgt['dim']
+        dim_weight = F.l1_loss(pred['pred_dim'], tgt['dim']) / dim_loss.mean()
+        angle_res = (pred['pred_angle'][:, 12:] * F.one_hot(tgt['heading_bin'], 12)).sum(1)
+        angle_loss = (F.cross_entropy(pred['pred_angle'][:, :12], tgt['heading_bin'], reduction='none')
+                      + (angle_res - tgt['heading_res']).abs())
+        return {
+            'loss_ce': F.cross_entropy(src_logits.transpose(1, 2), target_classes, empty_weight),
+            'class_error': 100 - (pred['pred_logits'].argmax(-1) == tgt['labels']).float().mean() * 100,
+            'cardinality_error': F.l1_loss(card_pred, torch.tensor([float(len(t['labels'])) for t in targets])),
+            'loss_bbox': (pred['pred_boxes'] - tgt['boxes']).abs().sum() / num_boxes,
+            'loss_giou': (1 - giou).sum() / num_boxes,
+            'loss_bev': (pred['pred_bev'] - tgt['bev']).abs().sum() / num_boxes,
+            'loss_dim': (dim_loss * dim_weight).sum() / num_boxes,
+            'loss_angle': angle_loss.sum() / num_boxes,
+        }
+
+    def test_set_criterion(self):
+        torch.manual_seed(0)
+        n_layers, bs, n_queries, n_classes, eos_coef = 3, 2, 10, 4, 0.1
+
+        def layer_outputs():
+            return {'pred_logits': torch.randn(bs, n_queries, n_classes + 1),
+                    'pred_boxes': torch.rand(bs, n_queries, 4), 'pred_bev': torch.randn(bs, n_queries, 2),
+                    'pred_dim': torch.randn(bs, n_queries, 2), 'pred_angle': torch.randn(bs, n_queries, 24)}
+
+        def target(n):
+            return {'labels': torch.randint(n_classes, (n,)), 'boxes': torch.rand(n, 4) * 0.5 + 0.25,
+                    'bev': torch.randn(n, 2), 'dim': torch.rand(n, 2) + 1,
+                    'heading_bin': torch.randint(12, (n,)), 'heading_res': torch.randn(n)}
+
+        outputs = layer_outputs()
+        outputs['aux_outputs'] = [layer_outputs() for _ in range(n_layers - 1)]
+        # one image with several targets and one with a single target
+        targets = [target(3), target(1)]
+        matcher = HungarianMatcher()
+        criterion = SetCriterion(n_classes, matcher, {}, eos_coef,
+                                 ['labels', 'boxes', 'cardinality', 'bev', 'dim', 'angle'])
+        losses = criterion(outputs, targets)
+        self.assertNotIn('boxes_xyxy', targets[0])
+
+        layers = [({k: v for k, v in outputs.items() if k != 'aux_outputs'}, '')]
+        layers += [(aux_outputs, f'_{i}') for i, aux_outputs in enumerate(outputs['aux_outputs'])]
+        expected = {}
+        for layer_outputs, suffix in layers:
+            reference = self.reference_losses(layer_outputs, targets, matcher(layer_outputs, targets), 4, eos_coef)
+            if suffix:
+                # the classification error is only logged for the last layer
+                del reference['class_error']
+            expected.update({k + suffix: v for k, v in reference.items()})
+        self.assertEqual(set(losses), set(expected))
+        for k, v in expected.items():
+            self.assertTrue(torch.allclose(losses[k], v, atol=1e-6), k)
+
+        # the losses can also be computed directly on targets without "boxes_xyxy"
+        box_losses = criterion.get_loss('boxes', layers[0][0], targets, matcher(layers[0][0], targets), 4)
+        for k, v in box_losses.items():
+            self.assertTrue(torch.allclose(v, expected[k], atol=1e-6), k)
+
+    def test_postprocess(self):
+        logits, boxes = torch.randn(2, 10, 5), torch.rand(2, 10, 4)
+        target_sizes = torch.tensor([[480, 640], [375, 1242]])
+        results = PostProcess()({'pred_logits': logits, 'pred_boxes': boxes}, target_sizes)
+        scores, labels = logits.softmax(-1)[..., :-1].max(-1)
+        for b, result in enumerate(results):
+            img_h, img_w = target_sizes[b].tolist()
+            scale = torch.tensor([img_w, img_h, img_w, img_h])
+            self.assertTrue(torch.allclose(result['boxes'], box_ops.box_cxcywh_to_xyxy(boxes[b]) * scale))
+            self.assertTrue(result['scores'].equal(scores[b]))
+            self.assertTrue(result['labels'].equal(labels[b]))
+
+    def test_mlp_load_old_layout(self):
+        mlp = MLP(8, 16, 4, 3)
+        linears = [mlp.layers[0], mlp.layers[2], mlp.layers[4]]
+        # the Linear layers used to be stored in a ModuleList, without the ReLUs
+        old_state_dict = {f'layers.{i}.{name}': getattr(linear, name).clone()
+                          for i, linear in enumerate(linears) for name in ('weight', 'bias')}
+        new_mlp = MLP(8, 16, 4, 3)
+        new_mlp.load_state_dict(old_state_dict)
+        x = torch.rand(5, 8)
+        self.assertTrue(new_mlp(x).equal(mlp(x)))
+
+    def test_model_half(self):
+        model = make_small_detr().half().eval()
+        x = nested_tensor_from_tensor_list([torch.rand(3, 64, 64).half(), torch.rand(3, 64, 80).half()])
+        out = model(x)
+        self.assertEqual(out['pred_logits'].dtype, torch.float16)
+        self.assertEqual(out['pred_boxes'].dtype, torch.float16)
+
+    def test_model_bf16_outputs_float32(self):
+        model = make_small_detr(bf16=True).eval()
+        x = nested_tensor_from_tensor_list([torch.rand(3, 64, 64), torch.rand(3, 64, 80)])
+        out = model(x)
+        self.assertEqual(out['pred_logits'].dtype, torch.float32)
+        self.assertEqual(out['pred_boxes'].dtype, torch.float32)
+
+    def test_inference_forward_script(self):
+        model = make_small_detr().eval()
+        scripted_model = torch.jit.script(model)
+        x = nested_tensor_from_tensor_list([torch.rand(3, 64, 64), torch.rand(3, 64, 80)])
+        out = model(x)
+        out_script = scripted_model.inference_forward(x.tensors, x.mask)
+        for key in ('pred_logits', 'pred_boxes', 'pred_bev', 'pred_dim', 'pred_angle'):
+            self.assertTrue(torch.allclose(out[key], out_script[key], atol=1e-6), key)
+
+    def test_model_bf16_script(self):
+        model = make_small_detr(bf16=True).eval()
+        x = nested_tensor_from_tensor_list([torch.rand(3, 64, 64), torch.rand(3, 64, 80)])
+        with self.assertRaisesRegex(RuntimeError, "can't be scripted"):
+            torch.jit.script(model)
+        # the same weights can be scripted without autocast
+        model.bf16 = False
+        torch.jit.script(model).inference_forward(x.tensors, x.mask)
+
     def test_position_encoding_script(self):
         m1, m2 = PositionEmbeddingSine(), PositionEmbeddingLearned()
         mm1, mm2 = torch.jit.script(m1), torch.jit.script(m2)  # noqa